@@ -0,0 +1,189 @@
+#! /usr/bin/env python
+# vim: set fileencoding=utf-8 :
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) InfoTeCS JSC. All rights reserved.
+# Licensed under the MIT license. See LICENSE file
+# in the project root for full license information.
+#
+""" Compiled export plan and its on-disk cache """
+
+from collections import OrderedDict
+import logging
+import os
+import re
+
+from domain_tools import __version__
+
+logger = logging.getLogger("export_plan")
+
+# Attribute type (RFC 4512): a descriptor or a numeric OID. Options such as
+# ";binary" or ";range=0-1499" are left for the server to check.
+ATTRIBUTE_RE = re.compile(r'^(?:[A-Za-z][A-Za-z0-9-]*|[0-9]+(?:\.[0-9]+)*)$')
+DEFAULT_DECODER = 'format_unicode'
+DEFAULT_CACHE_DIR = os.path.join(
+    os.path.expanduser('~'), '.cache', 'domain_tools')
+
+
+class ExportPlan(object):
+    """Validated field bindings with schema types and decoders."""
+
+    def __init__(self, field_bindings, attribute_types=None):
+        self.field_bindings = field_bindings
+        self.attribute_types = attribute_types \
+            if attribute_types is not None else {}
+
+    @property
+    def attributes(self):
+        """Unique domain attributes to request, in the bindings order."""
+        return list(OrderedDict.fromkeys(self.field_bindings.values()))
+
+    def is_resolved(self):
+        """Check whether all attributes have been resolved in the schema."""
+        return all(x in self.attribute_types for x in self.attributes)
+
+    def resolve_schema(self, schema):
+        """Look up attribute types in the server schema."""
+        from ldap3.protocol.formatters.standard import find_attribute_helpers
+
+        for name in self.attributes:
+            base_name = name.split(';')[0]
+            if base_name not in schema.attribute_types:
+                logger.error("Unknown domain attribute: %s", name)
+                return False
+            attr_type = schema.attribute_types[base_name]
+            # ldap3 formats values by the returned name, so attributes with
+            # options are decoded without the schema type and kept as lists.
+            format_type = attr_type if name == base_name else None
+            decoder = find_attribute_helpers(format_type, name, None)[0]
+            self.attribute_types[name] = {
+                'names': attribute_names(name, attr_type),
+                'syntax': attr_type.syntax,
+                'single_value': bool(format_type and format_type.single_value),
+                'decoder': decoder.__name__ if decoder else DEFAULT_DECODER}
+        return True
+
+    def decoders(self):
+        """Map attribute names to ldap3 formatters."""
+        from ldap3.protocol.formatters import formatters
+
+        # ldap3 only applies custom formatters passed as a plain dict, which
+        # is case-sensitive: map every spelling the server may return.
+        result = {}
+        for name, attr_type in self.attribute_types.items():
+            decoder = getattr(formatters, attr_type['decoder'])
+            for alias in [name] + attr_type.get('names', []):
+                result[alias] = decoder
+        return result
+
+    def decode_entry(self, entry):
+        """Unwrap single-valued attributes returned without the schema."""
+        attributes = entry.get('attributes')
+        if attributes:
+            for name, attr_type in self.attribute_types.items():
+                value = attributes.get(name)
+                if attr_type['single_value'] and isinstance(value, list) \
+                        and len(value) == 1:
+                    attributes[name] = value[0]
+        return entry
+
+    def to_json(self):
+        """Serialize plan to JSON string."""
+        import json
+        return json.dumps({
+            'version': __version__,
+            'field_bindings': list(self.field_bindings.items()),
+            'attribute_types': self.attribute_types}, sort_keys=True)
+
+    @classmethod
+    def from_json(cls, json_plan):
+        """Initialize plan from JSON object."""
+        from ldap3.protocol.formatters import formatters
+
+        if json_plan['version'] != __version__:
+            raise ValueError("plan version %s" % json_plan['version'])
+        plan = cls(OrderedDict(json_plan['field_bindings']),
+                   json_plan['attribute_types'])
+        for attr_type in plan.attribute_types.values():
+            if not hasattr(formatters, attr_type['decoder']):
+                raise ValueError("unknown decoder %s" % attr_type['decoder'])
+        return plan
+
+
+def attribute_names(name, attr_type):
+    """Schema spellings of the attribute name, with the same options."""
+    options = name[len(name.split(';')[0]):]
+    names = attr_type.name if attr_type.name else []
+    if isinstance(names, str):
+        names = [names]
+    return [x + options for x in names if x + options != name]
+
+
+def compile_plan(settings):
+    """Validate settings' field bindings and build the plan."""
+    if not settings.field_bindings:
+        logger.error("No valid field_bindings found in the settings.")
+        return None
+    for field, attribute in settings.field_bindings.items():
+        if not isinstance(attribute, str) or \
+                not ATTRIBUTE_RE.match(attribute.split(';')[0]):
+            logger.error("Invalid domain attribute for %s: %r",
+                         field, attribute)
+            return None
+    return ExportPlan(OrderedDict(settings.field_bindings))
+
+
+def settings_digest(settings_file):
+    """Hash the settings file contents, None if it can't be reread."""
+    import hashlib
+
+    if not settings_file.seekable():
+        return None
+    settings_file.seek(0)
+    digest = hashlib.sha256(
+        settings_file.read().encode('utf-8')).hexdigest()
+    settings_file.seek(0)
+    return digest
+
+
+def load_plan(cache_dir, digest):
+    """Load the cached plan, None if missing or stale."""
+    import json
+
+    plan_path = os.path.join(cache_dir, digest + '.json')
+    try:
+        with open(plan_path, encoding='utf-8') as plan_file:
+            plan = ExportPlan.from_json(json.load(plan_file))
+    except (IOError, OSError):
+        return None
+    except (ValueError, KeyError, TypeError) as exp:
+        logger.warning("Ignoring invalid cached plan %s: %s", plan_path, exp)
+        return None
+    logger.debug("Using cached plan %s", plan_path)
+    return plan
+
+
+def save_plan(plan, cache_dir, digest):
+    """Store the plan in the cache directory."""
+    import tempfile
+
+    plan_path = os.path.join(cache_dir, digest + '.json')
+    temp_path = None
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        # A unique temporary file per run, so concurrent runs don't collide
+        temp_fd, temp_path = tempfile.mkstemp(
+            prefix=digest + '.', suffix='.tmp', dir=cache_dir)
+        with open(temp_fd, 'w', encoding='utf-8') as plan_file:
+            plan_file.write(plan.to_json())
+        os.replace(temp_path, plan_path)
+    except (IOError, OSError) as exp:
+        logger.warning("Failed to save plan to %s: %s", plan_path, exp)
+        if temp_path is not None:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+        return False
+    logger.debug("Plan saved to %s", plan_path)
+    return True
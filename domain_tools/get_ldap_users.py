@@ -8,18 +8,16 @@
 #
 """ Import users' info from the domain server to the csv file. """
 
+# Heavy modules (ldap3, ssl, csv, ...) are imported inside the functions
+# that need them, so that "--version" and "gen-defaults" start fast.
+
 import argparse
-import csv
-import getpass
-import json
 import logging
-import ssl
 import sys
 
-from ldap3 import Server, Connection
-from ldap3.core.exceptions import LDAPExceptionError, LDAPOperationResult
-
 from domain_tools import __version__
+from domain_tools.export_plan import (DEFAULT_CACHE_DIR, compile_plan,
+                                      load_plan, save_plan, settings_digest)
 from domain_tools.settings import Settings
 
 logger = logging.getLogger("get_ldap_users")
@@ -27,6 +25,7 @@ logger = logging.getLogger("get_ldap_users")
 
 def parse_settings_file(parsed_args):
     """ Parse JSON file with settings """
+    import json
     logger.debug("Passed JSON file with settings: %s",
                  parsed_args.settings_file.name)
     settings = Settings()
@@ -55,11 +54,33 @@ def parse_settings_file(parsed_args):
 
 def ask_password(username):
     """ Ask password interactively """
+    import getpass
     return getpass.getpass("Please, enter domain password for %s: " % username)
 
 
-def get_ldap_users(settings):
+def get_export_plan(settings, args):
+    """Get the cached export plan or compile a new one"""
+    digest = None
+    if args.cache_dir:
+        digest = settings_digest(args.settings_file)
+    if digest is not None:
+        plan = load_plan(args.cache_dir, digest)
+        if plan is not None:
+            return plan, digest
+    return compile_plan(settings), digest
+
+
+def get_ldap_users(settings, plan=None):
     """ Get users list from LDAPS server """
+    import ssl
+    from ldap3 import Server, Connection, NONE, SCHEMA
+    from ldap3.core.exceptions import LDAPExceptionError, LDAPOperationResult
+
+    if plan is None:
+        plan = compile_plan(settings)
+        if plan is None:
+            return None
+
     if settings.use_ssl:
         try:
             ldap_server_cert = ssl.get_server_certificate(
@@ -68,9 +89,12 @@ def get_ldap_users(settings):
         except (ssl.SSLError, ConnectionError) as exp:
             logger.warning("While trying to get the server certificate: %s",
                            exp)
+    resolved = plan.is_resolved()
     ldap_server = Server(settings.ldap_server,
                          port=settings.ldap_port,
-                         use_ssl=settings.use_ssl)
+                         use_ssl=settings.use_ssl,
+                         get_info=NONE if resolved else SCHEMA,
+                         formatter=plan.decoders() if resolved else None)
     connection = Connection(ldap_server,
                             user=settings.ldap_username,
                             password=settings.ldap_password,
@@ -82,17 +106,29 @@ def get_ldap_users(settings):
         logger.error("Failed to connect to the server: %s", exp)
         return None
 
+    if not resolved:
+        schema = connection.server.schema
+        if schema is None or not schema.attribute_types:
+            # The plan is only a cache: export without it, as ldap3 would
+            logger.warning("The server didn't provide the schema, "
+                           "the export plan won't be cached.")
+        elif not plan.resolve_schema(schema):
+            return None
+
     entry_generator = connection.extend.standard.paged_search(
         search_base=settings.search_base,
         search_filter='(objectClass=person)',
-        attributes=list(settings.field_bindings.values()),
+        attributes=plan.attributes,
         paged_size=10,
         generator=True)
-    return entry_generator
+    return (plan.decode_entry(entry) for entry in entry_generator)
 
 
 def save_records_to_csv(entries, mappings, output_path):
     """Save LDAP records to the CSV file"""
+    import csv
+    from ldap3.core.exceptions import LDAPExceptionError, LDAPOperationResult
+
     try:
         with open(output_path, 'w+', newline='', encoding='utf-8') as out_file:
             table = csv.writer(out_file, delimiter=';')
@@ -148,6 +184,10 @@ def create_parser():
     import_parser.add_argument(
         'output_file', metavar='OUTPUT-CSV-FILE',
         help="Path to the output csv file.")
+    import_parser.add_argument(
+        '--cache-dir', dest='cache_dir', default=DEFAULT_CACHE_DIR,
+        help="Directory to cache compiled export plans in. Pass an empty "
+             "string to disable caching.")
     import_parser.add_argument(
         '--preview', dest='preview_result',
         action='store_true',
@@ -169,13 +209,21 @@ def import_users(args):
     """Import users from domain"""
     settings = parse_settings_file(args)
     if settings is not None:
+        plan, digest = get_export_plan(settings, args)
+        if plan is None:
+            return
+        cached = plan.is_resolved()
         if settings.ldap_password == '*':
             settings.ldap_password = ask_password(settings.ldap_username)
 
-        entries = get_ldap_users(settings)
+        entries = get_ldap_users(settings, plan)
         if entries is not None:
+            # The plan depends only on the settings and the server schema,
+            # so it is cached once resolved, whatever the export outcome.
+            if digest is not None and not cached and plan.is_resolved():
+                save_plan(plan, args.cache_dir, digest)
             save_records_to_csv(entries,
-                                settings.field_bindings,
+                                plan.field_bindings,
                                 args.output_file)
 
 
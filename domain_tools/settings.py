@@ -8,10 +8,8 @@
 #
 """ Settings keeper implementation """
 
-import json
 from collections import OrderedDict
 import logging
-import pprint
 
 logger = logging.getLogger("settings")
 
@@ -36,6 +34,7 @@ class Settings(object):
 
     def to_json(self):
         """Serialize settings to JSON string."""
+        import json
         temp_dict = self.__dict__.copy()
         temp_dict['field_bindings'] = {v[0]: [i, v[1]] for i, v in
                                        enumerate(self.field_bindings.items())}
@@ -43,6 +42,7 @@ class Settings(object):
 
     def from_json(self, json_settings):
         """Initialize settings from JSON string."""
+        import pprint
         self.ldap_username = json_settings['ldap_username']
         self.ldap_password = json_settings['ldap_password']
         self.ldap_server = json_settings['ldap_server']
@@ -0,0 +1,266 @@
+#! /usr/bin/env python
+# vim: set fileencoding=utf-8 :
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) InfoTeCS JSC. All rights reserved.
+# Licensed under the MIT license. See LICENSE file
+# in the project root for full license information.
+#
+""" export_plan tests """
+import json
+import os
+import tempfile
+import unittest
+from collections import namedtuple, OrderedDict
+from datetime import datetime
+from unittest.mock import patch
+
+from ldap3.operation.search import checked_attributes_to_dict
+from ldap3.protocol.rfc4512 import SchemaInfo
+from ldap3.protocol.schemas.ad2012R2 import ad_2012_r2_schema
+
+from domain_tools import export_plan
+from domain_tools.settings import Settings
+
+AttrType = namedtuple('AttrType', "name oid oid_info syntax single_value")
+Schema = namedtuple('Schema', "attribute_types")
+
+SCHEMA = Schema({
+    'sAMAccountName': AttrType(
+        ['sAMAccountName'], '1.2.840.113556.1.4.221', None,
+        '1.3.6.1.4.1.1466.115.121.1.15', True),
+    'mail': AttrType(
+        ['mail'], '0.9.2342.19200300.100.1.3', None,
+        '1.3.6.1.4.1.1466.115.121.1.15', True),
+    'memberOf': AttrType(
+        ['memberOf'], '1.2.840.113556.1.2.102', None,
+        '1.3.6.1.4.1.1466.115.121.1.12', False),
+    'userCertificate': AttrType(
+        ['userCertificate'], '2.5.4.36', None,
+        '1.3.6.1.4.1.1466.115.121.1.40', False),
+    'member': AttrType(
+        ['member'], '2.5.4.31', None,
+        '1.3.6.1.4.1.1466.115.121.1.12', False),
+    'logonCount': AttrType(
+        ['logonCount'], '1.2.840.113556.1.4.169', None,
+        '1.3.6.1.4.1.1466.115.121.1.27', True),
+})
+
+
+def make_plan(bindings):
+    """Compile the plan for the given JSON bindings."""
+    settings = Settings()
+    settings.use_json_bindings(bindings)
+    return export_plan.compile_plan(settings)
+
+
+class TestCompilePlan(unittest.TestCase):
+    """Test bindings validation."""
+    def test_valid_bindings(self):
+        """Test plan keeps bindings order and unique attributes."""
+        plan = make_plan({
+            'login': [2, 'sAMAccountName'],
+            'email': [1, 'mail'],
+            'email2': [3, 'mail'],
+        })
+        self.assertIsNotNone(plan)
+        self.assertEqual(list(plan.field_bindings.keys()),
+                         ['email', 'login', 'email2'])
+        self.assertEqual(plan.attributes, ['mail', 'sAMAccountName'])
+        self.assertFalse(plan.is_resolved())
+
+    def test_no_bindings(self):
+        """Test missing bindings."""
+        self.assertIsNone(make_plan(None))
+        self.assertIsNone(make_plan({'login': ['sAMAccountName']}))
+
+    def test_invalid_attribute(self):
+        """Test malformed attribute names."""
+        self.assertIsNone(make_plan({'login': [1, 'sAM AccountName']}))
+        self.assertIsNone(make_plan({'login': [1, 10]}))
+        self.assertIsNone(make_plan({'login': [1, '']}))
+        self.assertIsNone(make_plan({'login': [1, ';binary']}))
+
+    def test_attribute_options(self):
+        """Test OIDs and attribute options are accepted."""
+        plan = make_plan({
+            'login': [1, '1.2.840.113556.1.4.221'],
+            'cert': [2, 'userCertificate;binary'],
+            'members': [3, 'member;range=0-1499'],
+        })
+        self.assertIsNotNone(plan)
+
+
+class TestResolveSchema(unittest.TestCase):
+    """Test resolving attributes against the schema."""
+    def test_resolve(self):
+        """Test types and decoders are selected."""
+        plan = make_plan({
+            'login': [1, 'sAMAccountName'],
+            'groups': [2, 'memberOf'],
+            'logons': [3, 'logonCount'],
+        })
+        self.assertTrue(plan.resolve_schema(SCHEMA))
+        self.assertTrue(plan.is_resolved())
+        self.assertTrue(plan.attribute_types['sAMAccountName']['single_value'])
+        self.assertFalse(plan.attribute_types['memberOf']['single_value'])
+        self.assertEqual(plan.attribute_types['logonCount']['decoder'],
+                         'format_integer')
+        self.assertEqual(plan.attribute_types['memberOf']['decoder'],
+                         'format_unicode')
+        self.assertIn('logonCount', plan.decoders())
+
+    def test_resolve_options(self):
+        """Test attributes with options are resolved by the base name."""
+        plan = make_plan({
+            'cert': [1, 'userCertificate;binary'],
+            'members': [2, 'member;range=0-1499'],
+            'logons': [3, 'logonCount;x-test'],
+        })
+        self.assertTrue(plan.resolve_schema(SCHEMA))
+        self.assertTrue(plan.is_resolved())
+        self.assertEqual(
+            plan.attribute_types['userCertificate;binary']['syntax'],
+            '1.3.6.1.4.1.1466.115.121.1.40')
+        # ldap3 doesn't match options against the schema: values stay lists
+        logons = plan.attribute_types['logonCount;x-test']
+        self.assertFalse(logons['single_value'])
+        self.assertEqual(logons['decoder'], 'format_unicode')
+        self.assertIn('member;range=0-1499', plan.decoders())
+
+    def test_unknown_attribute(self):
+        """Test attribute missing in the schema."""
+        plan = make_plan({'login': [1, 'sAMAccountNam']})
+        self.assertFalse(plan.resolve_schema(SCHEMA))
+        self.assertFalse(plan.is_resolved())
+
+    def test_decode_entry(self):
+        """Test single-valued attributes are unwrapped."""
+        plan = make_plan({
+            'login': [1, 'sAMAccountName'],
+            'groups': [2, 'memberOf'],
+            'email': [3, 'mail'],
+        })
+        plan.resolve_schema(SCHEMA)
+        entry = plan.decode_entry({'attributes': {
+            'sAMAccountName': ['admin'], 'memberOf': ['users'], 'mail': []}})
+        self.assertEqual(entry['attributes'], {
+            'sAMAccountName': 'admin', 'memberOf': ['users'], 'mail': []})
+        self.assertEqual(plan.decode_entry({'uri': 'ldap://a'}),
+                         {'uri': 'ldap://a'})
+
+
+class TestDecoders(unittest.TestCase):
+    """Test cached decoders against ldap3 formatting."""
+    RAW_ATTRIBUTES = [
+        {'type': 'sAMAccountName', 'vals': [b'admin']},
+        {'type': 'whenCreated', 'vals': [b'20200102030405.0Z']},
+        {'type': 'logonCount', 'vals': [b'3']},
+        {'type': 'memberOf', 'vals': [b'CN=g1', b'CN=g2']},
+        {'type': 'userAccountControl', 'vals': [b'512']},
+    ]
+
+    def test_same_as_schema(self):
+        """Test values decoded without the schema match the schema run."""
+        schema = SchemaInfo.from_json(ad_2012_r2_schema)
+        plan = make_plan({
+            'login': [1, 'samaccountname'],
+            'created': [2, 'WHENCREATED'],
+            'logons': [3, 'logonCount'],
+            'groups': [4, 'memberOf'],
+            'flags': [5, 'userAccountControl'],
+        })
+        self.assertTrue(plan.resolve_schema(schema))
+        with_schema = checked_attributes_to_dict(
+            self.RAW_ATTRIBUTES, schema, None)
+        without_schema = plan.decode_entry({
+            'attributes': checked_attributes_to_dict(
+                self.RAW_ATTRIBUTES, None, plan.decoders())})['attributes']
+        self.assertEqual(with_schema['whenCreated'].replace(tzinfo=None),
+                         datetime(2020, 1, 2, 3, 4, 5))
+        self.assertEqual(with_schema['logonCount'], 3)
+        self.assertEqual(dict(without_schema), dict(with_schema))
+
+
+class TestPlanCache(unittest.TestCase):
+    """Test storing plans on disk."""
+    def setUp(self):
+        self.cache = tempfile.TemporaryDirectory()
+        self.cache_dir = os.path.join(self.cache.name, 'plans')
+
+    def tearDown(self):
+        self.cache.cleanup()
+
+    def test_round_trip(self):
+        """Test saved plan is loaded back."""
+        plan = make_plan({
+            'login': [2, 'sAMAccountName'],
+            'logons': [1, 'logonCount'],
+        })
+        plan.resolve_schema(SCHEMA)
+        self.assertTrue(export_plan.save_plan(plan, self.cache_dir, 'abc'))
+        loaded = export_plan.load_plan(self.cache_dir, 'abc')
+        self.assertIsNotNone(loaded)
+        self.assertTrue(loaded.is_resolved())
+        self.assertEqual(loaded.field_bindings, plan.field_bindings)
+        self.assertEqual(loaded.attribute_types, plan.attribute_types)
+
+    def test_failed_save(self):
+        """Test failed save leaves no temporary files behind."""
+        plan = make_plan({'login': [1, 'sAMAccountName']})
+        plan.resolve_schema(SCHEMA)
+        with patch('os.replace', side_effect=OSError("busy")):
+            self.assertFalse(
+                export_plan.save_plan(plan, self.cache_dir, 'abc'))
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+    def test_concurrent_save(self):
+        """Test overlapping saves use their own temporary files."""
+        plan = make_plan({'login': [1, 'sAMAccountName']})
+        plan.resolve_schema(SCHEMA)
+        temp_paths = []
+        real_replace = os.replace
+
+        def save_again(src, dst):
+            """Start another save while this one is in flight."""
+            temp_paths.append(src)
+            if len(temp_paths) == 1:
+                self.assertTrue(
+                    export_plan.save_plan(plan, self.cache_dir, 'abc'))
+            real_replace(src, dst)
+
+        with patch('os.replace', side_effect=save_again):
+            self.assertTrue(
+                export_plan.save_plan(plan, self.cache_dir, 'abc'))
+        self.assertEqual(len(set(temp_paths)), 2)
+        self.assertEqual(os.listdir(self.cache_dir), ['abc.json'])
+
+    def test_missing_plan(self):
+        """Test cache miss."""
+        self.assertIsNone(export_plan.load_plan(self.cache_dir, 'abc'))
+
+    def test_stale_plan(self):
+        """Test plans from other versions and broken plans are ignored."""
+        os.makedirs(self.cache_dir)
+        with open(os.path.join(self.cache_dir, 'old.json'), 'w') as plan_file:
+            json.dump({'version': '0.0.1', 'field_bindings': [],
+                       'attribute_types': {}}, plan_file)
+        with open(os.path.join(self.cache_dir, 'bad.json'), 'w') as plan_file:
+            plan_file.write('{"version":')
+        self.assertIsNone(export_plan.load_plan(self.cache_dir, 'old'))
+        self.assertIsNone(export_plan.load_plan(self.cache_dir, 'bad'))
+
+    def test_settings_digest(self):
+        """Test digest depends on the contents only."""
+        with tempfile.TemporaryFile('w+') as first,\
+                tempfile.TemporaryFile('w+') as second:
+            first.write('{"a": 1}')
+            second.write('{"a": 2}')
+            digest = export_plan.settings_digest(first)
+            self.assertEqual(first.read(), '{"a": 1}')
+            self.assertEqual(digest, export_plan.settings_digest(first))
+            self.assertNotEqual(digest, export_plan.settings_digest(second))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -8,15 +8,24 @@
 #
 """ get_ldap_users tests """
 import os
+import subprocess
+import sys
 import tempfile
 import unittest
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 from collections import namedtuple
 import logging
 
-from domain_tools import get_ldap_users
+import ldap3
+from ldap3.operation.search import checked_attributes_to_dict
+from ldap3.protocol.rfc4512 import SchemaInfo
+from ldap3.protocol.schemas.ad2012R2 import ad_2012_r2_schema
+
+from domain_tools import export_plan, get_ldap_users
 from domain_tools.settings import Settings
 
+AD_SCHEMA = SchemaInfo.from_json(ad_2012_r2_schema)
+
 logging.basicConfig(
     level=logging.DEBUG,
     format='%(asctime)s:%(name)s:%(levelname)s:%(message)s',
@@ -200,6 +209,134 @@ class TestParseSettings(unittest.TestCase):
         os.remove(temp_path)
 
 
+class TestImportUsers(unittest.TestCase):
+    """Test import command."""
+    SETTINGS = (
+        '{"ldap_server": "192.168.78.12","ldap_port":44445,'
+        '"use_ssl":false,"ldap_username":"infotecs\\\\Admin",'
+        '"ldap_password":"Qwerty1","search_base":"DC=infotecs",'
+        '"field_bindings":{"login":[1,"sAMAccountName"],'
+        '"groups":[2,"memberOf"],"logons":[3,"logonCount"],'
+        '"created":[4,"whenCreated"]}}')
+    RAW_ENTRY = [
+        {'type': 'sAMAccountName', 'vals': [b'admin']},
+        {'type': 'memberOf', 'vals': [b'CN=g1', b'CN=g2']},
+        {'type': 'logonCount', 'vals': [b'3']},
+        {'type': 'whenCreated', 'vals': [b'20200102030405.0Z']},
+    ]
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.cache_dir = os.path.join(self.temp_dir.name, 'cache')
+        self.settings_path = os.path.join(self.temp_dir.name, 'settings.json')
+        with open(self.settings_path, 'w', encoding='utf-8') as settings_file:
+            settings_file.write(self.SETTINGS)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def run_import(self, raw_entries, output_path, schema=AD_SCHEMA):
+        """Run import command against the mocked server.
+
+        Raw entries are formatted by ldap3 the way the search does it, with
+        the schema and the formatter the server was created with.
+        """
+        def paged_search(**_):
+            kwargs = server.call_args[1]
+            use_schema = schema if kwargs['get_info'] == ldap3.SCHEMA \
+                else None
+            return iter(
+                {'attributes': checked_attributes_to_dict(
+                    raw_entry, use_schema, kwargs['formatter'])}
+                for raw_entry in raw_entries)
+
+        connection = MagicMock()
+        connection.server.schema = schema
+        connection.extend.standard.paged_search.side_effect = paged_search
+        args = namedtuple(
+            'Args',
+            "domain_user domain_password settings_file output_file cache_dir")
+        with open(self.settings_path, encoding='utf-8') as settings_file,\
+                patch('ldap3.Server') as server,\
+                patch('ldap3.Connection', return_value=connection):
+            get_ldap_users.import_users(
+                args(None, None, settings_file, output_path, self.cache_dir))
+        return server
+
+    def test_cached_plan(self):
+        """Test second run reuses the plan and skips the schema."""
+        first_output = os.path.join(self.temp_dir.name, 'first.csv')
+        second_output = os.path.join(self.temp_dir.name, 'second.csv')
+        server = self.run_import([self.RAW_ENTRY], first_output)
+        self.assertEqual(server.call_args[1]['get_info'], ldap3.SCHEMA)
+        self.assertIsNone(server.call_args[1]['formatter'])
+        with open(self.settings_path, encoding='utf-8') as settings_file:
+            digest = export_plan.settings_digest(settings_file)
+        self.assertEqual(os.listdir(self.cache_dir), [digest + '.json'])
+
+        server = self.run_import([self.RAW_ENTRY], second_output)
+        self.assertEqual(server.call_args[1]['get_info'], ldap3.NONE)
+
+        with open(first_output, encoding='utf-8') as output_file:
+            first = output_file.read()
+        with open(second_output, encoding='utf-8') as output_file:
+            second = output_file.read()
+        self.assertEqual(
+            first, "admin;['CN=g1', 'CN=g2'];3;2020-01-02 03:04:05+00:00\n")
+        self.assertEqual(first, second)
+
+    def test_no_schema(self):
+        """Test import runs without caching when the schema is missing."""
+        output_path = os.path.join(self.temp_dir.name, 'out.csv')
+        server = self.run_import([self.RAW_ENTRY], output_path, schema=None)
+        self.assertEqual(server.call_args[1]['get_info'], ldap3.SCHEMA)
+        self.assertFalse(os.path.exists(self.cache_dir))
+        with open(output_path, encoding='utf-8') as output_file:
+            self.assertEqual(
+                output_file.read(),
+                "['admin'];['CN=g1', 'CN=g2'];['3'];['20200102030405.0Z']\n")
+
+    def test_unknown_attribute(self):
+        """Test attribute missing in the schema stops the import."""
+        with open(self.settings_path, 'w', encoding='utf-8') as settings_file:
+            settings_file.write(
+                self.SETTINGS.replace('logonCount', 'logonCounter'))
+        output_path = os.path.join(self.temp_dir.name, 'out.csv')
+        self.run_import([self.RAW_ENTRY], output_path)
+        self.assertFalse(os.path.exists(output_path))
+        self.assertFalse(os.path.exists(self.cache_dir))
+
+    def test_plan_saved_on_failed_export(self):
+        """Test resolved plan is cached even if the output can't be written."""
+        self.run_import((), self.temp_dir.name)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+
+    def test_invalid_bindings_offline(self):
+        """Test invalid bindings are rejected before connecting."""
+        with tempfile.NamedTemporaryFile('w+') as settings_file,\
+                tempfile.TemporaryDirectory() as cache_dir:
+            settings_file.write(
+                '{"ldap_server": "192.168.78.12","ldap_port":44445,'
+                '"use_ssl":true,"ldap_username":"infotecs\\\\Admin",'
+                '"ldap_password":"*","search_base":"DC=infotecs",'
+                '"field_bindings":{"email":[1,"e mail"]}}')
+            settings_file.seek(0)
+            args = namedtuple(
+                'Args',
+                "domain_user domain_password settings_file output_file "
+                "cache_dir")
+            parsed_args = args(None, None, settings_file,
+                               os.path.join(cache_dir, 'out.csv'), cache_dir)
+            with patch('ssl.get_server_certificate') as get_cert,\
+                    patch('ldap3.Connection') as connection,\
+                    patch('getpass.getpass') as ask:
+                get_ldap_users.import_users(parsed_args)
+            get_cert.assert_not_called()
+            connection.assert_not_called()
+            ask.assert_not_called()
+            self.assertEqual(os.listdir(cache_dir), [])
+
+
 class TestSave(unittest.TestCase):
     """Test results serializing."""
     def test_invalid_output(self):
@@ -318,5 +455,60 @@ class TestParamParser(unittest.TestCase):
             self.fail("Unexpected exception: %s" % exp)
 
 
+@unittest.skipIf(sys.version_info < (3, 7), "-X importtime requires 3.7+")
+class TestImportTime(unittest.TestCase):
+    """Test CLI startup cost."""
+    HEAVY_MODULES = ('ldap3', 'ssl', 'csv', 'getpass')
+    RUN_COMMAND = ("import sys; sys.argv = ['get_ldap_users'] + %r; "
+                   "from domain_tools.get_ldap_users import main; main()")
+
+    @staticmethod
+    def import_times(code):
+        """Return {module: cumulative import time} for the given code."""
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', code],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            universal_newlines=True)
+        times = {}
+        for line in result.stderr.splitlines():
+            if not line.startswith('import time:'):
+                continue
+            fields = line[len('import time:'):].split('|')
+            try:
+                times[fields[2].strip()] = int(fields[1])
+            except (IndexError, ValueError):
+                continue
+        return times
+
+    def min_import_time(self, module, runs=3):
+        """Return the best cumulative import time of the module."""
+        return min(self.import_times('import %s' % module)[module]
+                   for _ in range(runs))
+
+    def test_no_heavy_imports(self):
+        """Test heavy modules are not imported at startup."""
+        times = self.import_times('import domain_tools.get_ldap_users')
+        for module in self.HEAVY_MODULES + ('json',):
+            self.assertNotIn(module, times)
+
+    def test_commands_without_heavy_imports(self):
+        """Test --version and gen-defaults don't import heavy modules."""
+        for args in (['--version'], ['gen-defaults'], []):
+            times = self.import_times(self.RUN_COMMAND % args)
+            self.assertIn('domain_tools.get_ldap_users', times)
+            for module in self.HEAVY_MODULES:
+                self.assertNotIn(module, times, args)
+
+    def test_import_budget(self):
+        """Test startup import time stays within budget."""
+        # The budget is relative rather than a wall-clock number to be
+        # stable across CI machines: importing the CLI module used to pull
+        # in ldap3 (~60% of its cost), so it must now be cheaper than
+        # importing ldap3 alone.
+        budget = self.min_import_time('ldap3')
+        self.assertLess(self.min_import_time('domain_tools.get_ldap_users'),
+                        budget)
+
+
 if __name__ == '__main__':
     unittest.main()